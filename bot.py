@@ -1,10 +1,22 @@
 # ==================== PART 1: IMPORTS AND CONFIGURATION ====================
 
 import os
+import sys
+import copy
+import time
+import random
+import functools
+import weakref
 import asyncio
 import json
 import logging
+import logging.handlers
+import atexit
+import queue
+import signal
+import string
 from pathlib import Path
+from collections import deque
 from datetime import datetime, timezone
 
 # Optional DB drivers
@@ -15,23 +27,68 @@ except Exception:
 
 try:
     import psycopg
+    from psycopg.types.json import set_json_loads
     from psycopg_pool import AsyncConnectionPool
 except Exception:
     psycopg = None
     AsyncConnectionPool = None
 
-from aiohttp import web, ClientSession
+# Optional fast JSON codec for settings/upload payloads and the fallback file
+try:
+    import orjson
+except Exception:
+    orjson = None
+
+json_loads = orjson.loads if orjson is not None else json.loads
+
+# orjson refuses integers outside 64 bits, which stdlib json and JSONB accept;
+# those (rare) documents go through the stdlib encoder instead
+def json_dumps(obj) -> str:
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj, default=str).decode()
+        except TypeError:
+            pass
+    return json.dumps(obj, default=str)
+
+def json_dumps_pretty(obj) -> bytes:
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj, default=str, option=orjson.OPT_INDENT_2)
+        except TypeError:
+            pass
+    return json.dumps(obj, default=str, indent=2).encode('utf-8')
+
+# Optional libuv event loop; must be installed before the pyrogram Client grabs its loop
+try:
+    import uvloop
+    uvloop.install()
+except Exception:
+    uvloop = None
+
+from aiohttp import web, ClientSession, ClientTimeout, TCPConnector
+from aiolimiter import AsyncLimiter
+from cachetools import LRUCache, TTLCache
 from pyrogram import Client, filters, idle
 from pyrogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
 from pyrogram.enums import ParseMode
-from pyrogram.errors import StopPropagation  # ADDED THIS LINE
+from pyrogram.errors import StopPropagation, RPCError, MessageNotModified  # ADDED THIS LINE
+from pyrogram.errors import FloodWait, ChatWriteForbidden, ChatAdminRequired, PeerIdInvalid
 
 # ---- Logging ----
+# Handlers only enqueue records; a listener thread does the formatting and
+# stream writes so a slow stderr never stalls the event loop
+_log_queue = queue.SimpleQueue()
+_log_handler = logging.StreamHandler()
+_log_handler.setFormatter(logging.Formatter('%(asctime)s [%(levelname)s] %(message)s'))
+_log_listener = logging.handlers.QueueListener(_log_queue, _log_handler)
+_log_listener.start()
+atexit.register(_log_listener.stop)
 logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s [%(levelname)s] %(message)s',
+    level=os.getenv('LOG_LEVEL', 'INFO').upper(),
+    format='%(message)s',  # the listener's handler adds timestamp and level
     handlers=[
-        logging.StreamHandler()
+        logging.handlers.QueueHandler(_log_queue)
     ]
 )
 logger = logging.getLogger(__name__)
@@ -45,19 +102,39 @@ WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8080'))
 DATA_FILE = Path(os.getenv('DATA_FILE', 'data.json'))
 DATABASE_URL = os.getenv('DATABASE_URL')
 SELF_PING_URL = os.getenv('SELF_PING_URL', os.getenv('RENDER_EXTERNAL_URL', ''))
+SELF_PING_INTERVAL = 600
+SELF_PING_RETRY = 30
+SELF_PING_JITTER = 30
+SELF_PING_ERROR_LOG_INTERVAL = 300
 ADMIN_IDS_STR = os.getenv('ADMIN_IDS', '').strip()
-ADMIN_IDS = [int(x.strip()) for x in ADMIN_IDS_STR.split(',') if x.strip().isdigit()] if ADMIN_IDS_STR else []
+ADMIN_IDS = frozenset(int(x.strip()) for x in ADMIN_IDS_STR.split(',') if x.strip().isdigit())
+SETTINGS_CACHE_TTL = float(os.getenv('SETTINGS_CACHE_TTL', '60'))
+UPLOAD_FLUSH_INTERVAL = float(os.getenv('UPLOAD_FLUSH_INTERVAL', '3'))
+UPLOAD_FLUSH_BATCH = 64
+MAX_CONCURRENT_UPLOADS = int(os.getenv('MAX_CONCURRENT_UPLOADS', '8'))
+INPUT_TIMEOUT = float(os.getenv('INPUT_TIMEOUT', '600'))
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '8'))
+# Bot API allows roughly 30 messages per second across all chats
+SEND_RATE_LIMIT = int(os.getenv('SEND_RATE_LIMIT', '30'))
+FALLBACK_SAVE_DELAY = 1.0
+DB_CLOSE_TIMEOUT = 5.0
+# Share of Render's ~30s SIGTERM grace period given to queued uploads at shutdown
+CHAT_DRAIN_TIMEOUT = 15.0
+SETTINGS_FLUSH_DELAY = 0.2
+SETTINGS_FLUSH_MAX_DELAY = 30.0  # cap for the retry backoff while the DB is failing
+# Commands older than this when they reach a handler are dropped (0 disables)
+STALE_UPDATE_SECONDS = float(os.getenv('STALE_UPDATE_SECONDS', '30'))
 
 if not BOT_TOKEN or not API_HASH or API_ID == 0:
     logger.error('❌ BOT_TOKEN, API_ID or API_HASH missing. Set environment variables!')
     exit(1)
 
-logger.info(f'🔑 API_ID: {API_ID}')
-logger.info(f'🔑 API_HASH: {"*" * len(API_HASH) if API_HASH else "NOT SET"}')
-logger.info(f'🤖 BOT_TOKEN: {"*" * 20 if BOT_TOKEN else "NOT SET"}')
+logger.info('🔑 API_ID: %s', API_ID)
+logger.info('🔑 API_HASH: %s', '*' * len(API_HASH) if API_HASH else 'NOT SET')
+logger.info('🤖 BOT_TOKEN: %s', '*' * 20 if BOT_TOKEN else 'NOT SET')
 
 if ADMIN_IDS:
-    logger.info(f'🔧 Admin IDs configured: {ADMIN_IDS}')
+    logger.info('🔧 Admin IDs configured: %s', sorted(ADMIN_IDS))
 else:
     logger.warning('⚠️ No admin IDs configured. Admin features will be disabled.')
 
@@ -72,20 +149,90 @@ bot = Client(
 )
 
 # ---- DB globals ----
+# Failures a DB helper may absorb: driver/server errors and dropped connections.
+# Anything else is a bug and should surface.
+DB_ERRORS = (OSError, asyncio.TimeoutError)
+if asyncpg is not None:
+    DB_ERRORS += (asyncpg.PostgresError, asyncpg.InterfaceError)
+if psycopg is not None:
+    DB_ERRORS += (psycopg.Error,)
+
 _pg_pool = None
 _psycopg_pool = None
 USE_ASYNCPG = False
 USE_PSYCOG = False
 
 # ---- In-memory/fallback storage ----
-user_locks = {}
+# A user's lock lives only while some handler holds or waits on it
+user_locks = weakref.WeakValueDictionary()
 fallback = {'users': {}, 'uploads': [], 'global': {'total_uploads': 0}}
-last_bot_msgs = {}
-waiting_for_input = {}
+_fallback_save_task = None
+_fallback_write_lock = asyncio.Lock()
+# chat_id -> id of the menu/reply we last sent there; oldest chats are forgotten first
+last_bot_msgs = LRUCache(maxsize=50000)
+# Pending input flows expire so abandoned ones don't accumulate
+waiting_for_input = TTLCache(maxsize=10000, ttl=INPUT_TIMEOUT)
+
+# ---- In-process read caches ----
+# user_id -> settings; bounded so a large user base can't grow it without limit
+_settings_cache = TTLCache(maxsize=10000, ttl=SETTINGS_CACHE_TTL)
+_welcome_cache = None  # (monotonic ts, welcome dict or None)
+_settings_loads = {}  # user_id -> in-flight load task shared by concurrent cache misses
+_dirty_settings = {}  # user_id -> packed settings not yet written to Postgres
+_settings_flush_task = None
+_settings_flush_delay = SETTINGS_FLUSH_DELAY  # grows while flushes fail, reset on success
+_settings_flush_lock = asyncio.Lock()  # flushes must land in order or an older batch could win
+
+# ---- Upload log buffer ----
+_upload_buffer = []  # (user_id, ts, data) rows waiting for flush_uploads()
+_upload_flusher = None
+_upload_flush_event = None
+
+# ---- Background work ----
+_background_tasks = set()
+_ping_task = None
+http_session = None  # shared aiohttp ClientSession, opened in main()
+_storage_ready = asyncio.Event()
+_chat_queues = {}  # chat_id -> deque of pending jobs, drained by one worker per chat
+_chat_workers = set()  # running _chat_worker tasks, awaited at shutdown
+_accepting_jobs = True  # cleared when shutdown starts
+_upload_slots = asyncio.Semaphore(MAX_CONCURRENT_UPLOADS)
+_send_limiter = AsyncLimiter(SEND_RATE_LIMIT, 1)  # shared by every outgoing bot message
 
 # ---- Defaults ----
 ALL_QUALITIES = ['480p', '720p', '1080p', '4K', '2160p']
+# selected_qualities is stored as a bitmask over ALL_QUALITIES; only ever append
+# to that list, reordering it would remap every saved selection
+QUALITY_BITS = {q: 1 << i for i, q in enumerate(ALL_QUALITIES)}
 DEFAULT_CAPTION = """• 𝗦𝗘𝗔𝗦𝗢𝗡 {season} || Episode {episode} ({quality})\n{total_episode_text}"""
+WELCOME_TEXT = """👋 <b>Welcome {first_name}!</b>
+
+🤖 <b>Your Upload Assistant</b>
+
+- Auto-caption and forward videos
+- Multi-quality support
+- Episode tracking (per user)
+- Channel setup and preview
+
+Start by setting your target channel and caption."""
+STATS_TEMPLATE = ("📊 <b>Your Statistics</b>\n\n"
+                  "👤 User ID: <code>%(user_id)s</code>\n"
+                  "📤 Total: <code>%(total)s</code> | Today: <code>%(today)s</code>\n\n"
+                  "📺 Season: <code>%(season)s</code>\n"
+                  "🎬 Episode: <code>%(episode)s</code>\n"
+                  "🔢 Total Episodes: <code>%(total_episode)s</code>\n"
+                  "🎥 Progress: <code>%(video_count)s/%(quality_count)s</code>\n"
+                  "🎯 Channel: <code>%(target_chat_id)s</code>")
+HELP_TEXT = ("/start - Open menu\n"
+             "/help - This help\n"
+             "/stats - Your stats\n"
+             "/admin - Admin panel (admins only)")
+ADMIN_PANEL_TEXT = '👑 Admin Panel'
+QUALITY_MENU_TEXT = 'Toggle qualities'
+CAPTION_PROMPT = 'Send new caption template (placeholders: {season},{episode},{total_episode},{quality})'
+PREVIEW_TEMPLATE = '🔍 Caption Preview:\n%(preview)s\n\nChannel: %(target)s'
+UPLOAD_STATS_TEMPLATE = 'Your uploads: total %(total)s | today %(today)s'
+GLOBAL_STATS_TEMPLATE = 'Global users: %(total)s | Storage: %(storage)s'
 
 # ==================== END OF PART 1 ====================
 
@@ -95,7 +242,7 @@ DEFAULT_CAPTION = """• 𝗦𝗘𝗔𝗦𝗢𝗡 {season} || Episode {episode}
 def load_fallback():
     if DATA_FILE.exists():
         try:
-            d = json.loads(DATA_FILE.read_text(encoding='utf-8'))
+            d = json_loads(DATA_FILE.read_bytes())
             fallback['users'].update(d.get('users', {}))
             fallback['uploads'].extend(d.get('uploads', []))
             fallback['global'].update(d.get('global', {}))
@@ -103,48 +250,104 @@ def load_fallback():
         except Exception:
             logger.exception('Failed to load fallback file')
 
-def save_fallback_sync():
+def _write_fallback_file(data: bytes):
     try:
-        DATA_FILE.write_text(json.dumps(fallback, default=str, indent=2), encoding='utf-8')
+        DATA_FILE.write_bytes(data)
     except Exception:
         logger.exception('Failed to save fallback file')
 
 async def save_fallback():
-    loop = asyncio.get_running_loop()
-    await loop.run_in_executor(None, save_fallback_sync)
+    """Schedule a write of the fallback file; a burst of changes shares one write"""
+    global _fallback_save_task
+    if _fallback_save_task is None:
+        _fallback_save_task = spawn(_save_fallback_later())
+
+async def _save_fallback_later():
+    global _fallback_save_task
+    await asyncio.sleep(FALLBACK_SAVE_DELAY)
+    # Changes from here on schedule a fresh write
+    _fallback_save_task = None
+    await write_fallback()
+
+async def write_fallback():
+    async with _fallback_write_lock:
+        # Serialise on the loop so no handler mutates the dict mid-dump; only the disk write is threaded
+        data = json_dumps_pretty(fallback)
+        await asyncio.to_thread(_write_fallback_file, data)
+
+# ---- SQL statements ----
+# Every hot query goes through one fixed string per driver so asyncpg's
+# statement cache and psycopg's prepared statements keep hitting the same plan.
+PG_LOAD_SETTINGS = 'WITH ins AS (INSERT INTO users (user_id, settings) VALUES ($1, $2) ON CONFLICT DO NOTHING RETURNING settings) SELECT settings FROM ins UNION ALL SELECT settings FROM users WHERE user_id = $1 LIMIT 1'
+PG_UPSERT_SETTINGS = 'INSERT INTO users (user_id, settings) SELECT u, s::jsonb FROM unnest($1::bigint[], $2::text[]) AS t(u, s) ON CONFLICT (user_id) DO UPDATE SET settings = EXCLUDED.settings'
+PG_INSERT_UPLOAD = 'INSERT INTO uploads (user_id, ts, data) VALUES ($1, $2, $3)'
+PG_UPLOAD_STATS = 'SELECT COUNT(*), COUNT(*) FILTER (WHERE ts >= CURRENT_DATE) FROM uploads WHERE user_id = $1'
+
+PSY_LOAD_SETTINGS = 'WITH ins AS (INSERT INTO users (user_id, settings) VALUES (%(user_id)s, %(settings)s) ON CONFLICT DO NOTHING RETURNING settings) SELECT settings FROM ins UNION ALL SELECT settings FROM users WHERE user_id = %(user_id)s LIMIT 1'
+PSY_UPSERT_SETTINGS = 'INSERT INTO users (user_id, settings) SELECT u, s::jsonb FROM unnest(%s::bigint[], %s::text[]) AS t(u, s) ON CONFLICT (user_id) DO UPDATE SET settings = EXCLUDED.settings'
+PSY_COPY_UPLOADS = 'COPY uploads (user_id, ts, data) FROM STDIN'
+PSY_UPLOAD_STATS = 'SELECT COUNT(*), COUNT(*) FILTER (WHERE ts >= CURRENT_DATE) FROM uploads WHERE user_id = %s'
+
+SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS users (user_id BIGINT PRIMARY KEY, settings JSONB)',
+    'CREATE TABLE IF NOT EXISTS uploads (id SERIAL PRIMARY KEY, user_id BIGINT, ts TIMESTAMP WITH TIME ZONE, data JSONB)',
+    'CREATE INDEX IF NOT EXISTS uploads_user_ts_idx ON uploads (user_id, ts)',
+    'CREATE TABLE IF NOT EXISTS channel_info (user_id BIGINT, chat_id BIGINT, username TEXT, title TEXT, type TEXT, PRIMARY KEY(user_id, chat_id))',
+    'CREATE TABLE IF NOT EXISTS welcome_settings (id SERIAL PRIMARY KEY, message_type TEXT, file_id TEXT, caption TEXT)',
+)
 
 # ---- DB init ----
+async def _init_asyncpg_conn(conn):
+    # asyncpg hands JSONB over as text by default; decode it straight into dicts
+    await conn.set_type_codec('jsonb', encoder=json_dumps, decoder=json_loads, schema='pg_catalog')
+
 async def init_db():
     global _pg_pool, _psycopg_pool, USE_ASYNCPG, USE_PSYCOG
 
     if DATABASE_URL and asyncpg is not None:
         try:
-            _pg_pool = await asyncpg.create_pool(DATABASE_URL, min_size=1, max_size=10)
+            _pg_pool = await asyncpg.create_pool(DATABASE_URL, min_size=DB_POOL_SIZE, max_size=DB_POOL_SIZE, init=_init_asyncpg_conn)
             USE_ASYNCPG = True
             logger.info('Connected to Postgres via asyncpg')
             async with _pg_pool.acquire() as conn:
-                await conn.execute('CREATE TABLE IF NOT EXISTS users (user_id BIGINT PRIMARY KEY, settings JSONB)')
-                await conn.execute('CREATE TABLE IF NOT EXISTS uploads (id SERIAL PRIMARY KEY, user_id BIGINT, ts TIMESTAMP WITH TIME ZONE, data JSONB)')
+                for stmt in SCHEMA:
+                    await conn.execute(stmt)
             return
         except Exception:
             logger.exception('asyncpg init failed, falling back')
 
     if DATABASE_URL and psycopg is not None and AsyncConnectionPool is not None:
         try:
-            _psycopg_pool = AsyncConnectionPool(DATABASE_URL, min_size=1, max_size=10)
+            set_json_loads(json_loads)
+            # Open every connection up front so the first burst of users doesn't pay for handshakes
+            # Autocommit: single-statement reads/writes skip the BEGIN/COMMIT round trips;
+            # multi-statement writes opt in with conn.transaction()
+            _psycopg_pool = AsyncConnectionPool(DATABASE_URL, min_size=DB_POOL_SIZE, max_size=DB_POOL_SIZE, open=False, kwargs={'autocommit': True})
+            await _psycopg_pool.open(wait=True)
             USE_PSYCOG = True
             logger.info('Connected to Postgres via psycopg')
             async with _psycopg_pool.connection() as conn:
                 async with conn.cursor() as cur:
-                    await cur.execute("CREATE TABLE IF NOT EXISTS users (user_id BIGINT PRIMARY KEY, settings JSONB)")
-                    await cur.execute("CREATE TABLE IF NOT EXISTS uploads (id SERIAL PRIMARY KEY, user_id BIGINT, ts TIMESTAMP WITH TIME ZONE, data JSONB)")
-                    await conn.commit()
+                    for stmt in SCHEMA:
+                        await cur.execute(stmt)
             return
         except Exception:
             logger.exception('psycopg init failed, falling back')
 
-    load_fallback()
-    logger.info('Using JSON fallback storage')
+    await asyncio.to_thread(load_fallback)
+    logger.warning('⚠️ Using JSON fallback storage (%s); it is meant for local development, set DATABASE_URL in production', DATA_FILE)
+
+async def close_db():
+    # Shutdown must fit in Render's grace period; connections still checked out
+    # after DB_CLOSE_TIMEOUT are dropped instead of waited for
+    if _pg_pool is not None:
+        try:
+            await asyncio.wait_for(_pg_pool.close(), DB_CLOSE_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning('Postgres pool did not close within %ss, terminating', DB_CLOSE_TIMEOUT)
+            _pg_pool.terminate()
+    if _psycopg_pool is not None:
+        await _psycopg_pool.close(timeout=DB_CLOSE_TIMEOUT)
 
 # ---- User settings helpers ----
 async def default_user_settings(user_id=None):
@@ -159,73 +362,216 @@ async def default_user_settings(user_id=None):
         'target_chat_id': None
     }
 
+def _pack_settings(settings: dict) -> dict:
+    """Storage form of `settings`: selected_qualities collapsed to an int bitmask"""
+    stored = dict(settings)
+    stored['selected_qualities'] = sum(QUALITY_BITS.get(q, 0) for q in set(settings.get('selected_qualities', [])))
+    return stored
+
+def _unpack_settings(stored: dict) -> dict:
+    settings = dict(stored)
+    mask = settings.get('selected_qualities')
+    # Rows written before the bitmask still hold a plain list and pass through as-is
+    if isinstance(mask, int):
+        settings['selected_qualities'] = [q for q, bit in QUALITY_BITS.items() if mask & bit]
+    return settings
+
+def _cache_settings(user_id: int, settings: dict):
+    _settings_cache[user_id] = copy.deepcopy(settings)
+
 async def get_user_settings(user_id: int) -> dict:
+    # Serve repeat interactions from memory; callers get a private copy so
+    # unsaved mutations never leak into the cache.
+    cached = _settings_cache.get(user_id)
+    if cached is not None:
+        return copy.deepcopy(cached)
+    # A burst of updates from one user (album, double-tapped button) misses
+    # together; let them all wait on a single DB load instead of one each
+    task = _settings_loads.get(user_id)
+    if task is None:
+        task = asyncio.ensure_future(_load_and_cache_settings(user_id))
+        _settings_loads[user_id] = task
+        task.add_done_callback(lambda _: _settings_loads.pop(user_id, None))
+    return copy.deepcopy(await asyncio.shield(task))
+
+async def _load_and_cache_settings(user_id: int) -> dict:
+    settings = await _load_user_settings(user_id)
+    # set_user_settings() may have run while the load was in flight, and its
+    # flush may already have cleared the dirty entry; what it cached is newer
+    # than this read either way
+    cached = _settings_cache.get(user_id)
+    if cached is not None:
+        return cached
+    # A write still waiting for flush_settings() is newer than anything in the DB
+    pending = _dirty_settings.get(user_id)
+    if pending is not None:
+        settings = _unpack_settings(pending)
+    _cache_settings(user_id, settings)
+    return settings
+
+async def _load_user_settings(user_id: int) -> dict:
+    # *_LOAD_SETTINGS inserts the defaults for a new user and returns the stored
+    # settings in the same round trip; existing rows are left untouched
     if USE_ASYNCPG and _pg_pool:
+        d = await default_user_settings(user_id)
         async with _pg_pool.acquire() as conn:
-            row = await conn.fetchrow('SELECT settings FROM users WHERE user_id=$1', user_id)
-            if row and row['settings']:
-                return dict(row['settings'])
-            d = await default_user_settings(user_id)
-            await conn.execute('INSERT INTO users (user_id, settings) VALUES ($1, $2) ON CONFLICT DO NOTHING', user_id, d)
-            return d
+            row = await conn.fetchrow(PG_LOAD_SETTINGS, user_id, _pack_settings(d))
+        return _unpack_settings(row['settings']) if row and row['settings'] else d
 
     if USE_PSYCOG and _psycopg_pool:
+        d = await default_user_settings(user_id)
         async with _psycopg_pool.connection() as conn:
             async with conn.cursor() as cur:
-                await cur.execute('SELECT settings FROM users WHERE user_id = %s', (user_id,))
+                await cur.execute(PSY_LOAD_SETTINGS, {'user_id': user_id, 'settings': json_dumps(_pack_settings(d))}, prepare=True)
                 row = await cur.fetchone()
-                if row and row[0]:
-                    return row[0]
-                d = await default_user_settings(user_id)
-                await cur.execute('INSERT INTO users (user_id, settings) VALUES (%s, %s) ON CONFLICT DO NOTHING', (user_id, json.dumps(d)))
-                await conn.commit()
-                return d
+        return _unpack_settings(row[0]) if row and row[0] else d
 
     key = str(user_id)
     if key in fallback['users']:
-        return fallback['users'][key]
+        return _unpack_settings(fallback['users'][key])
     d = await default_user_settings(user_id)
-    fallback['users'][key] = d
+    fallback['users'][key] = _pack_settings(d)
     await save_fallback()
     return d
 
 async def set_user_settings(user_id: int, settings: dict):
-    if USE_ASYNCPG and _pg_pool:
-        async with _pg_pool.acquire() as conn:
-            await conn.execute('INSERT INTO users (user_id, settings) VALUES ($1, $2) ON CONFLICT (user_id) DO UPDATE SET settings = $2', user_id, settings)
-        return
-    if USE_PSYCOG and _psycopg_pool:
-        async with _psycopg_pool.connection() as conn:
-            async with conn.cursor() as cur:
-                await cur.execute('INSERT INTO users (user_id, settings) VALUES (%s, %s) ON CONFLICT (user_id) DO UPDATE SET settings = %s', (user_id, json.dumps(settings), json.dumps(settings)))
-                await conn.commit()
+    """Update the cache now and queue the DB write; rapid changes share one flush"""
+    global _settings_flush_task
+    _cache_settings(user_id, settings)
+    stored = _pack_settings(settings)
+    if (USE_ASYNCPG and _pg_pool) or (USE_PSYCOG and _psycopg_pool):
+        _dirty_settings[user_id] = stored
+        if _settings_flush_task is None:
+            _settings_flush_task = spawn(_flush_settings_later())
         return
-    fallback['users'][str(user_id)] = settings
+    fallback['users'][str(user_id)] = stored
     await save_fallback()
 
-async def log_upload_event(user_id: int, data: dict):
+async def _flush_settings_later():
+    global _settings_flush_task
+    await asyncio.sleep(_settings_flush_delay)
+    # Changes from here on schedule a fresh flush
+    _settings_flush_task = None
+    await flush_settings()
+
+async def flush_settings():
+    """Upsert every pending settings document in a single statement"""
+    global _settings_flush_task, _settings_flush_delay
+    async with _settings_flush_lock:
+        if not _dirty_settings:
+            return
+        rows = list(_dirty_settings.items())
+        # Encode up front: one document that can't be serialised is dropped on
+        # its own instead of failing the batch for every user, on every retry
+        encoded = []
+        for user_id, stored in rows:
+            try:
+                encoded.append((user_id, json_dumps(stored)))
+            except (TypeError, ValueError) as e:
+                logger.error('Dropping unserialisable settings for user %d: %s', user_id, e)
+                if _dirty_settings.get(user_id) is stored:
+                    del _dirty_settings[user_id]
+        if not encoded:
+            return
+        # Two parallel arrays unnested server-side: one round trip and one plan
+        # however many users are pending, instead of a statement per row
+        user_ids = [user_id for user_id, _ in encoded]
+        documents = [document for _, document in encoded]
+        try:
+            if USE_ASYNCPG and _pg_pool:
+                async with _pg_pool.acquire() as conn:
+                    # Sent as text[] and cast in SQL; the jsonb codec would encode the text again
+                    await conn.execute(PG_UPSERT_SETTINGS, user_ids, documents)
+            elif USE_PSYCOG and _psycopg_pool:
+                async with _psycopg_pool.connection() as conn:
+                    await conn.execute(PSY_UPSERT_SETTINGS, (user_ids, documents), prepare=True)
+        except DB_ERRORS as e:
+            # Log once when the outage starts, then back off instead of hammering the pool
+            if _settings_flush_delay == SETTINGS_FLUSH_DELAY:
+                logger.warning('Failed to write settings for %d users, retrying with backoff: %s', len(rows), e)
+            _settings_flush_delay = min(_settings_flush_delay * 2, SETTINGS_FLUSH_MAX_DELAY)
+            if _settings_flush_task is None:
+                _settings_flush_task = spawn(_flush_settings_later())
+            return
+        if _settings_flush_delay != SETTINGS_FLUSH_DELAY:
+            logger.info('Settings writes recovered; flushed %d users', len(rows))
+            _settings_flush_delay = SETTINGS_FLUSH_DELAY
+        # Entries stay dirty until written so cache misses in the meantime still
+        # see them; drop only those not replaced by a newer change mid-flush
+        for user_id, stored in rows:
+            if _dirty_settings.get(user_id) is stored:
+                del _dirty_settings[user_id]
+
+async def commit_upload(user_id: int, settings: dict, data: dict):
+    """Save the updated settings and queue the upload record for the next batch write"""
+    # The per-user counter lives in the settings document, so it is bumped here
+    # (the caller holds the user's lock) and saved with it; a separate SQL bump
+    # would be overwritten by the next upsert of the cached document
+    stats = settings.setdefault('global', {})
+    stats['total_uploads'] = stats.get('total_uploads', 0) + 1
+    log_upload_event(user_id, data)
+    await set_user_settings(user_id, settings)
+
+# ---- Buffered upload log ----
+def log_upload_event(user_id: int, data: dict):
+    _upload_buffer.append((user_id, datetime.now(timezone.utc), data))
+    _ensure_upload_flusher()
+    if len(_upload_buffer) >= UPLOAD_FLUSH_BATCH:
+        _upload_flush_event.set()
+
+def _ensure_upload_flusher():
+    global _upload_flusher, _upload_flush_event
+    if _upload_flusher is None or _upload_flusher.done():
+        _upload_flush_event = asyncio.Event()
+        _upload_flusher = spawn(_upload_flush_loop())
+
+async def _upload_flush_loop():
+    while True:
+        try:
+            await asyncio.wait_for(_upload_flush_event.wait(), UPLOAD_FLUSH_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        _upload_flush_event.clear()
+        await flush_uploads()
+
+async def flush_uploads():
+    """Write all buffered upload records in one transaction"""
+    if not _upload_buffer:
+        return
+    rows = _upload_buffer[:]
+    _upload_buffer.clear()
+    try:
+        await _write_uploads(rows)
+    except asyncio.CancelledError:
+        # Shutdown cancelled the flusher mid-write; the final flush picks these up
+        _upload_buffer[:0] = rows
+        raise
+    except DB_ERRORS as e:
+        logger.warning('Failed to write %d upload records, will retry: %s', len(rows), e)
+        _upload_buffer[:0] = rows
+    except Exception:
+        # Retrying a batch the code itself can't write would loop forever
+        logger.exception('Dropping %d upload records', len(rows))
+
+async def _write_uploads(rows):
     if USE_ASYNCPG and _pg_pool:
         async with _pg_pool.acquire() as conn:
-            await conn.execute('INSERT INTO uploads (user_id, ts, data) VALUES ($1, $2, $3)', user_id, datetime.now(timezone.utc), data)
-            try:
-                await conn.execute("UPDATE users SET settings = settings || jsonb_build_object('global', jsonb_build_object('total_uploads', (COALESCE((settings->'global'->>'total_uploads')::int,0)+1))) WHERE user_id = $1", user_id)
-            except Exception:
-                logger.exception('Failed to bump total_uploads (asyncpg)')
+            async with conn.transaction():
+                await conn.executemany(PG_INSERT_UPLOAD, rows)
         return
 
     if USE_PSYCOG and _psycopg_pool:
         async with _psycopg_pool.connection() as conn:
-            async with conn.cursor() as cur:
-                await cur.execute('INSERT INTO uploads (user_id, ts, data) VALUES (%s, %s, %s)', (user_id, datetime.now(timezone.utc), json.dumps(data)))
-                try:
-                    await cur.execute("UPDATE users SET settings = jsonb_set(COALESCE(settings, '{}'::jsonb), '{global,total_uploads}', to_jsonb((COALESCE((settings->'global'->>'total_uploads')::int,0)+1))) WHERE user_id = %s", (user_id,))
-                    await conn.commit()
-                except Exception:
-                    logger.exception('Failed to bump total_uploads (psycopg)')
+            async with conn.transaction():
+                async with conn.cursor() as cur:
+                    # COPY streams the whole batch in one statement instead of one INSERT per row
+                    async with cur.copy(PSY_COPY_UPLOADS) as cp:
+                        for u, ts, d in rows:
+                            await cp.write_row((u, ts, json_dumps(d)))
         return
 
-    fallback['uploads'].append({'user_id': user_id, 'ts': datetime.now(timezone.utc).isoformat(), 'data': data})
-    fallback['global']['total_uploads'] = fallback['global'].get('total_uploads', 0) + 1
+    fallback['uploads'].extend({'user_id': u, 'ts': ts.isoformat(), 'data': d} for u, ts, d in rows)
+    fallback['global']['total_uploads'] = fallback['global'].get('total_uploads', 0) + len(rows)
     await save_fallback()
 
 # ==================== END OF PART 2 ====================
@@ -233,17 +579,140 @@ async def log_upload_event(user_id: int, data: dict):
 # ==================== PART 3: UI UTILITIES AND MARKUP FUNCTIONS ====================
 
 def get_lock(user_id: int) -> asyncio.Lock:
-    if user_id not in user_locks:
-        user_locks[user_id] = asyncio.Lock()
-    return user_locks[user_id]
+    lock = user_locks.get(user_id)
+    if lock is None:
+        # keep a strong reference until the caller takes over, or the entry vanishes at once
+        lock = user_locks[user_id] = asyncio.Lock()
+    return lock
+
+def spawn(coro) -> asyncio.Task:
+    """create_task that holds a reference until the task is done"""
+    task = asyncio.get_running_loop().create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+def enqueue_for_chat(chat_id: int, job) -> bool:
+    """Run `job()` after earlier jobs of the same chat; different chats run concurrently.
+    Returns False once shutdown has started and the job was not queued."""
+    if not _accepting_jobs:
+        return False
+    jobs = _chat_queues.get(chat_id)
+    if jobs is None:
+        jobs = _chat_queues[chat_id] = deque()
+        worker = spawn(_chat_worker(chat_id, jobs))
+        _chat_workers.add(worker)
+        worker.add_done_callback(_chat_workers.discard)
+    jobs.append(job)
+    return True
+
+async def drain_chat_queues(timeout: float):
+    """Stop accepting jobs and give the queued ones up to `timeout` seconds to finish"""
+    global _accepting_jobs
+    _accepting_jobs = False
+    try:
+        await asyncio.wait_for(_wait_chat_workers(), timeout)
+    except asyncio.TimeoutError:
+        logger.warning('%d chat queues still busy after %ss, abandoning them', len(_chat_workers), timeout)
+
+async def _wait_chat_workers():
+    while _chat_workers:
+        await asyncio.gather(*_chat_workers, return_exceptions=True)
+
+async def _chat_worker(chat_id: int, jobs: deque):
+    try:
+        while jobs:
+            job = jobs.popleft()
+            async with _upload_slots:
+                try:
+                    await job()
+                except Exception:
+                    logger.exception('Queued job failed for chat %d', chat_id)
+    finally:
+        _chat_queues.pop(chat_id, None)
+
+# Input flows completed by a plain text reply
+TEXT_INPUT_MODES = ('caption', 'season', 'episode', 'total_episode', 'channel_id', 'admin_welcome_caption')
+# Upper bound for season / episode / total-episode input
+MAX_NUMERIC_INPUT = 99999
+# Numeric prompts: settings key (same as the input mode) -> confirmation text
+NUMERIC_INPUTS = {
+    'season': '✅ Season set to %d',
+    'episode': '✅ Episode set to %d and progress reset',
+    'total_episode': '✅ Total episodes set to %d',
+}
+
+def awaiting(*modes):
+    """Filter matching users whose pending input flow is one of `modes`"""
+    async def func(flt, _, m):
+        return m.from_user is not None and waiting_for_input.get(m.from_user.id) in flt.modes
+    return filters.create(func, 'Awaiting', modes=frozenset(modes))
+
+# Placeholder left in an episode's caption until the quality is known
+QUALITY_SLOT = '\x00quality\x00'
+CAPTION_FIELDS = frozenset({'season', 'episode', 'total_episode', 'total_episode_text', 'quality'})
+
+def caption_template_error(template: str):
+    """Return why `template` can't be rendered, or None if it's usable"""
+    try:
+        names = {field for _, field, _, _ in string.Formatter().parse(template) if field is not None}
+    except ValueError as e:
+        return f'Invalid caption template: {e}'
+    unknown = names - CAPTION_FIELDS
+    if unknown:
+        return 'Unknown placeholder(s): ' + ', '.join('{%s}' % n for n in sorted(unknown))
+    # Names alone don't catch format specs or conversions that fail on the
+    # actual values (e.g. {season:d} or {season!z}); render it for real
+    try:
+        template.format_map(_caption_fields(1, 1, 12, ALL_QUALITIES[0]))
+    except Exception as e:
+        return f'Invalid caption template: {e}'
+    return None
+
+def _caption_fields(season: int, episode: int, total_episode, quality: str = QUALITY_SLOT) -> dict:
+    return {
+        'season': f'{season:02}',
+        'episode': f'{episode:02}',
+        'total_episode': f'{total_episode or 0:02}',
+        'total_episode_text': f'Total Episodes: {total_episode}' if total_episode else '',
+        'quality': quality,
+    }
+
+@functools.lru_cache(maxsize=256)
+def _quality_is_plain(template: str) -> bool:
+    """True if every {quality} in `template` is bare, so QUALITY_SLOT can stand in for it"""
+    try:
+        return all(not spec and not conv for _, field, spec, conv in string.Formatter().parse(template) if field == 'quality')
+    except ValueError:
+        return True  # unparsable either way; _episode_caption falls back to DEFAULT_CAPTION
+
+@functools.lru_cache(maxsize=1024)
+def _episode_caption(template: str, season: int, episode: int, total_episode) -> str:
+    # Only {quality} changes between the uploads of one episode, so the
+    # template is parsed once per (template, season, episode, total) combination.
+    fields = _caption_fields(season, episode, total_episode)
+    try:
+        return template.format_map(fields)
+    except Exception:
+        return DEFAULT_CAPTION.format_map(fields)
+
+# Matches messages from configured admins; empty ADMIN_IDS matches nobody
+admins = filters.user(list(ADMIN_IDS))
 
 def render_caption(template: str, settings: dict, quality: str) -> str:
-    total_episode_text = f'Total Episodes: {settings.get("total_episode")}' if settings.get('total_episode') else ''
+    season, episode, total_episode = settings.get('season', 1), settings.get('episode', 1), settings.get('total_episode')
+    if _quality_is_plain(template):
+        return _episode_caption(template, season, episode, total_episode).replace(QUALITY_SLOT, quality)
+    # A spec or conversion on {quality} ({quality!r}, {quality:>6}) would apply
+    # to the placeholder, so those templates are formatted with the real value
+    fields = _caption_fields(season, episode, total_episode, quality)
     try:
-        return template.format(season=f"{settings.get('season',1):02}", episode=f"{settings.get('episode',1):02}", total_episode_text=total_episode_text, quality=quality)
+        return template.format_map(fields)
     except Exception:
-        return DEFAULT_CAPTION.format(season=settings.get('season', 1), episode=settings.get('episode', 1), quality=quality, total_episode_text=total_episode_text)
+        return DEFAULT_CAPTION.format_map(fields)
 
+# Static keyboards are built once and shared; pyrogram only reads them when sending
+@functools.lru_cache(maxsize=None)
 def menu_markup():
     return InlineKeyboardMarkup([
         [InlineKeyboardButton('🔍 Preview Caption', callback_data='preview')],
@@ -257,6 +726,7 @@ def menu_markup():
         [InlineKeyboardButton('❌ Cancel', callback_data='cancel')]
     ])
 
+@functools.lru_cache(maxsize=None)
 def admin_markup():
     return InlineKeyboardMarkup([
         [InlineKeyboardButton('📝 Set Welcome Message', callback_data='admin_set_welcome'), InlineKeyboardButton('👁️ Preview Welcome', callback_data='admin_preview_welcome')],
@@ -264,11 +734,23 @@ def admin_markup():
         [InlineKeyboardButton('⬅️ Back to Main', callback_data='back_to_main')]
     ])
 
+# Parameterised callbacks are sent as '<action>:<arg>' and dispatched on <action>
+TOGGLE_QUALITY = 'toggle_quality'
+
 def quality_markup(selected):
-    buttons = [[InlineKeyboardButton(('✅ ' if q in selected else '') + q, callback_data=f'toggle_quality_{q}')] for q in ALL_QUALITIES]
+    # Only membership matters, so every ordering of the same selection shares one markup
+    return _quality_markup(frozenset(selected))
+
+@functools.lru_cache(maxsize=64)
+def _quality_markup(selected: frozenset):
+    buttons = [[InlineKeyboardButton(('✅ ' if q in selected else '') + q, callback_data=f'{TOGGLE_QUALITY}:{q}')] for q in ALL_QUALITIES]
     buttons.append([InlineKeyboardButton('⬅️ Back', callback_data='back_to_main')])
     return InlineKeyboardMarkup(buttons)
 
+# Callbacks that rewrite the pressed menu instead of sending a new message
+IN_PLACE_CALLBACKS = frozenset({'stats', 'reset', 'back_to_main', 'cancel', TOGGLE_QUALITY})
+
+@functools.lru_cache(maxsize=None)
 def channel_markup():
     return InlineKeyboardMarkup([[InlineKeyboardButton('📤 Forward Message', callback_data='forward_channel'), InlineKeyboardButton('🔗 Send Username/ID', callback_data='send_channel_id')], [InlineKeyboardButton('⬅️ Back', callback_data='back_to_main')]])
 
@@ -276,24 +758,34 @@ def channel_markup():
 
 # ==================== PART 4: MESSAGE HANDLERS (COMMANDS) ====================
 
+# The client starts while init_db is still connecting; hold early updates here
+# so nothing falls through to the JSON fallback before the pool is up
+@bot.on_message(group=-2)
+@bot.on_callback_query(group=-2)
+async def wait_for_storage(c: Client, update):
+    await _storage_ready.wait()
+
+# After a restart or a burst, commands can sit in the backlog long enough that
+# the user has moved on; answering them late only spends send quota. Videos and
+# input replies are never dropped since they carry the user's content.
+@bot.on_message(filters.private & filters.command(['start', 'help', 'stats', 'admin']), group=-1)
+async def drop_stale_commands(c: Client, m: Message):
+    if STALE_UPDATE_SECONDS and m.date and time.time() - m.date.timestamp() > STALE_UPDATE_SECONDS:
+        logger.info('Dropping stale /%s from user %d', m.command[0], m.from_user.id)
+        raise StopPropagation
+
 @bot.on_message(filters.private & filters.command('start'))
 async def handle_start(c: Client, m: Message):
     user_id = m.from_user.id
     first_name = m.from_user.first_name or 'User'
     
-    logger.info(f'📨 User {user_id} ({first_name}) sent /start command')
+    logger.info('📨 User %d (%s) sent /start command', user_id, first_name)
     
     # Get user settings to initialize user in database
     settings = await get_user_settings(user_id)
     
-    # Delete user's command message
-    try:
-        await m.delete()
-    except Exception:
-        pass
-
-    # Delete previous bot message
-    await _delete_last(c, m.chat.id)
+    # Delete the command message and the previous bot message together
+    _delete_input_and_last(c, m)
 
     # Try to get custom welcome message
     welcome = await _get_welcome()
@@ -301,212 +793,156 @@ async def handle_start(c: Client, m: Message):
         caption = (welcome.get('caption') or '').format(first_name=first_name, user_id=user_id)
         try:
             if welcome.get('message_type') == 'photo':
-                sent = await c.send_photo(m.chat.id, welcome['file_id'], caption=caption, parse_mode=ParseMode.HTML, reply_markup=menu_markup())
+                await reply_and_track(c.send_photo, m.chat.id, m.chat.id, welcome['file_id'], caption=caption, parse_mode=ParseMode.HTML, reply_markup=menu_markup())
             elif welcome.get('message_type') == 'video':
-                sent = await c.send_video(m.chat.id, welcome['file_id'], caption=caption, parse_mode=ParseMode.HTML, reply_markup=menu_markup())
+                await reply_and_track(c.send_video, m.chat.id, m.chat.id, welcome['file_id'], caption=caption, parse_mode=ParseMode.HTML, reply_markup=menu_markup())
             elif welcome.get('message_type') == 'animation':
-                sent = await c.send_animation(m.chat.id, welcome['file_id'], caption=caption, parse_mode=ParseMode.HTML, reply_markup=menu_markup())
+                await reply_and_track(c.send_animation, m.chat.id, m.chat.id, welcome['file_id'], caption=caption, parse_mode=ParseMode.HTML, reply_markup=menu_markup())
             else:
-                sent = await c.send_message(m.chat.id, caption or f'Welcome {first_name}!', parse_mode=ParseMode.HTML, reply_markup=menu_markup())
-            last_bot_msgs[m.chat.id] = sent.id
-            logger.info(f'✅ User {user_id} ({first_name}) started the bot')
+                await reply_and_track(c.send_message, m.chat.id, m.chat.id, caption or f'Welcome {first_name}!', parse_mode=ParseMode.HTML, reply_markup=menu_markup())
+            logger.info('✅ User %d (%s) started the bot', user_id, first_name)
             return
         except Exception as e:
-            logger.error(f'Failed sending welcome media: {e}')
+            logger.warning('Failed sending welcome media: %s', e)
 
     # Default welcome message
-    text = (f"""👋 <b>Welcome {first_name}!</b>
-
-🤖 <b>Your Upload Assistant</b>
-
-- Auto-caption and forward videos
-- Multi-quality support
-- Episode tracking (per user)
-- Channel setup and preview
-
-Start by setting your target channel and caption.""")
-    
-    sent = await c.send_message(m.chat.id, text, parse_mode=ParseMode.HTML, reply_markup=menu_markup())
-    last_bot_msgs[m.chat.id] = sent.id
-    logger.info(f'✅ User {user_id} ({first_name}) started the bot')
+    text = WELCOME_TEXT.format(first_name=first_name)
+    await reply_and_track(c.send_message, m.chat.id, m.chat.id, text, parse_mode=ParseMode.HTML, reply_markup=menu_markup())
+    logger.info('✅ User %d (%s) started the bot', user_id, first_name)
 
 @bot.on_message(filters.private & filters.command('help'))
 async def handle_help(c: Client, m: Message):
-    try:
-        await m.delete()
-    except:
-        pass
-    await _delete_last(c, m.chat.id)
-    text = ("/start - Open menu\n/help - This help\n/stats - Your stats\n/admin - Admin panel (admins only)")
-    sent = await c.send_message(m.chat.id, text, parse_mode=ParseMode.HTML, reply_markup=menu_markup())
-    last_bot_msgs[m.chat.id] = sent.id
-    logger.info(f'User {m.from_user.id} used /help')
+    _delete_input_and_last(c, m)
+    await reply_and_track(c.send_message, m.chat.id, m.chat.id, HELP_TEXT, parse_mode=ParseMode.HTML, reply_markup=menu_markup())
+    logger.info('User %d used /help', m.from_user.id)
 
 @bot.on_message(filters.private & filters.command('stats'))
 async def handle_stats(c: Client, m: Message):
     user_id = m.from_user.id
-    settings = await get_user_settings(user_id)
-    total, today = await _get_user_upload_stats(user_id)
-    try:
-        await m.delete()
-    except:
-        pass
-    await _delete_last(c, m.chat.id)
-    text = (f"📊 <b>Your Statistics</b>\n\n"
-            f"👤 User ID: <code>{user_id}</code>\n"
-            f"📤 Total: <code>{total}</code> | Today: <code>{today}</code>\n\n"
-            f"📺 Season: <code>{settings['season']}</code>\n"
-            f"🎬 Episode: <code>{settings['episode']}</code>\n"
-            f"🔢 Total Episodes: <code>{settings['total_episode']}</code>\n"
-            f"🎥 Progress: <code>{settings['video_count']}/{len(settings['selected_qualities'])}</code>\n"
-            f"🎯 Channel: <code>{settings['target_chat_id']}</code>")
-    sent = await c.send_message(m.chat.id, text, parse_mode=ParseMode.HTML, reply_markup=menu_markup())
-    last_bot_msgs[m.chat.id] = sent.id
-    logger.info(f'User {user_id} viewed stats')
+    # Settings (usually a cache hit) and the upload counts don't depend on each other
+    settings, (total, today) = await asyncio.gather(get_user_settings(user_id), _get_user_upload_stats(user_id))
+    _delete_input_and_last(c, m)
+    text = STATS_TEMPLATE % {
+        'user_id': user_id,
+        'total': total,
+        'today': today,
+        'season': settings['season'],
+        'episode': settings['episode'],
+        'total_episode': settings['total_episode'],
+        'video_count': settings['video_count'],
+        'quality_count': len(settings['selected_qualities']),
+        'target_chat_id': settings['target_chat_id'],
+    }
+    await reply_and_track(c.send_message, m.chat.id, m.chat.id, text, parse_mode=ParseMode.HTML, reply_markup=menu_markup())
+    logger.info('User %d viewed stats', user_id)
 
 @bot.on_message(filters.private & filters.command('admin'))
 async def handle_admin(c: Client, m: Message):
-    if not ADMIN_IDS or m.from_user.id not in ADMIN_IDS:
-        await m.reply('❌ You are not an admin')
-        logger.warning(f'Unauthorized admin access attempt by {m.from_user.id}')
+    if m.from_user.id not in ADMIN_IDS:
+        async with _send_limiter:
+            await m.reply('❌ You are not an admin')
+        logger.warning('Unauthorized admin access attempt by %d', m.from_user.id)
         return
-    try:
-        await m.delete()
-    except:
-        pass
-    await _delete_last(c, m.chat.id)
-    sent = await c.send_message(m.chat.id, '👑 Admin Panel', parse_mode=ParseMode.HTML, reply_markup=admin_markup())
-    last_bot_msgs[m.chat.id] = sent.id
-    logger.info(f'✅ Admin panel accessed by user_id: {m.from_user.id}')
+    _delete_input_and_last(c, m)
+    await reply_and_track(c.send_message, m.chat.id, m.chat.id, ADMIN_PANEL_TEXT, parse_mode=ParseMode.HTML, reply_markup=admin_markup())
+    logger.info('✅ Admin panel accessed by user_id: %d', m.from_user.id)
 
 # ==================== END OF PART 4 ====================
 
 # ==================== PART 5: MESSAGE HANDLERS (TEXT, FORWARD, MEDIA) ====================
 
-@bot.on_message(filters.private & (filters.text | filters.sticker) & ~filters.command(['start', 'help', 'stats', 'admin']))
+@bot.on_message(filters.private & (filters.text | filters.sticker) & awaiting(*TEXT_INPUT_MODES) & ~filters.command(['start', 'help', 'stats', 'admin']))
 async def handle_text_input(c: Client, m: Message):
     user_id = m.from_user.id
-    if user_id not in waiting_for_input:
+    mode = waiting_for_input.get(user_id)
+    if mode is None:
         return
-    mode = waiting_for_input[user_id]
-    try:
-        await m.delete()
-    except:
-        pass
-    await _delete_last(c, m.chat.id)
-    settings = await get_user_settings(user_id)
+    _delete_input_and_last(c, m)
+
+    # Network lookups and writes that don't touch the user's settings stay outside the lock
+    if mode == 'admin_welcome_caption':
+        data = waiting_for_input.get(f'{user_id}_welcome_data')
+        if not data:
+            waiting_for_input.pop(user_id, None)
+            async with _send_limiter:
+                await c.send_message(m.chat.id, '⚠️ Session lost. Start over from /admin')
+            return
+        caption = m.text or ''
+        ok = await _save_welcome(data['message_type'], data['file_id'], caption)
+        if ok:
+            waiting_for_input.pop(user_id, None)
+            waiting_for_input.pop(f'{user_id}_welcome_data', None)
+            await reply_and_track(c.send_message, m.chat.id, m.chat.id, '✅ Welcome saved', reply_markup=admin_markup())
+        else:
+            async with _send_limiter:
+                await c.send_message(m.chat.id, '❌ Failed to save welcome')
+        return
+    if mode == 'channel_id':
+        text = (m.text or '').strip()
+        try:
+            chat = await c.get_chat(text if text.startswith('@') else int(text))
+        except Exception as e:
+            await reply_and_track(c.send_message, m.chat.id, m.chat.id, f'❌ Failed to set channel: {e}')
+            return
 
+    # Only the settings read-modify-write is serialised with uploads; replies go out after
+    error = None
     async with get_lock(user_id):
+        settings = await get_user_settings(user_id)
         if mode == 'caption':
             if not m.text:
-                await c.send_message(m.chat.id, 'Send a valid caption text')
-                return
-            settings['base_caption'] = m.text
-            await set_user_settings(user_id, settings)
-            del waiting_for_input[user_id]
-            sent = await c.send_message(m.chat.id, '✅ Caption updated', reply_markup=menu_markup())
-            last_bot_msgs[m.chat.id] = getattr(sent, 'message_id', getattr(sent, 'id', None))
-            return
-        if mode == 'season':
-            if not m.text or not m.text.isdigit():
-                await c.send_message(m.chat.id, 'Send a valid number')
-                return
-            settings['season'] = int(m.text)
-            await set_user_settings(user_id, settings)
-            del waiting_for_input[user_id]
-            sent = await c.send_message(m.chat.id, f'✅ Season set to {settings["season"]}', reply_markup=menu_markup())
-            last_bot_msgs[m.chat.id] = getattr(sent, 'message_id', getattr(sent, 'id', None))
-            return
-        if mode == 'episode':
-            if not m.text or not m.text.isdigit():
-                await c.send_message(m.chat.id, 'Send a valid number')
-                return
-            settings['episode'] = int(m.text)
-            settings['video_count'] = 0
-            await set_user_settings(user_id, settings)
-            del waiting_for_input[user_id]
-            sent = await c.send_message(m.chat.id, f'✅ Episode set to {settings["episode"]} and progress reset', reply_markup=menu_markup())
-            last_bot_msgs[m.chat.id] = getattr(sent, 'message_id', getattr(sent, 'id', None))
-            return
-        if mode == 'total_episode':
-            if not m.text or not m.text.isdigit():
-                await c.send_message(m.chat.id, 'Send a valid number')
-                return
-            settings['total_episode'] = int(m.text)
-            await set_user_settings(user_id, settings)
-            del waiting_for_input[user_id]
-            sent = await c.send_message(m.chat.id, f'✅ Total episodes set to {settings["total_episode"]}', reply_markup=menu_markup())
-            last_bot_msgs[m.chat.id] = getattr(sent, 'message_id', getattr(sent, 'id', None))
-            return
-        if mode == 'channel_id':
-            text = m.text.strip()
-            try:
-                if text.startswith('@'):
-                    chat = await c.get_chat(text)
-                else:
-                    chat = await c.get_chat(int(text))
-                settings['target_chat_id'] = chat.id
-                await set_user_settings(user_id, settings)
-                await _save_channel_info(user_id, chat)
-                del waiting_for_input[user_id]
-                sent = await c.send_message(m.chat.id, f'✅ Channel set to {chat.title} ({chat.id})', reply_markup=menu_markup())
-                last_bot_msgs[m.chat.id] = getattr(sent, 'message_id', getattr(sent, 'id', None))
-            except Exception as e:
-                sent = await c.send_message(m.chat.id, f'❌ Failed to set channel: {e}')
-                last_bot_msgs[m.chat.id] = getattr(sent, 'message_id', getattr(sent, 'id', None))
-            return
-        if mode == 'admin_welcome_caption':
-            data = waiting_for_input.get(f'{user_id}_welcome_data')
-            if not data:
-                del waiting_for_input[user_id]
-                await c.send_message(m.chat.id, '⚠️ Session lost. Start over from /admin')
-                return
-            caption = m.text or ''
-            ok = await _save_welcome(data['message_type'], data['file_id'], caption)
-            if ok:
-                del waiting_for_input[user_id]
-                del waiting_for_input[f'{user_id}_welcome_data']
-                sent = await c.send_message(m.chat.id, '✅ Welcome saved', reply_markup=admin_markup())
-                last_bot_msgs[m.chat.id] = getattr(sent, 'message_id', getattr(sent, 'id', None))
+                error = 'Send a valid caption text'
             else:
-                await c.send_message(m.chat.id, '❌ Failed to save welcome')
-            return
+                error = caption_template_error(m.text)
+                if error is None:
+                    settings['base_caption'] = m.text
+                    done = '✅ Caption updated'
+        elif mode in NUMERIC_INPUTS:
+            # Plain ASCII digits only: int() would also take ' 12 ', '+5' and '1_000'
+            text = m.text or ''
+            value = int(text) if text.isascii() and text.isdigit() and len(text) <= len(str(MAX_NUMERIC_INPUT)) else -1
+            if not 0 <= value <= MAX_NUMERIC_INPUT:
+                error = 'Send a valid number'
+            else:
+                settings[mode] = value
+                if mode == 'episode':
+                    settings['video_count'] = 0
+                done = NUMERIC_INPUTS[mode] % value
+        elif mode == 'channel_id':
+            settings['target_chat_id'] = chat.id
+            done = f'✅ Channel set to {chat.title} ({chat.id})'
+        if error is None:
+            await set_user_settings(user_id, settings)
+            waiting_for_input.pop(user_id, None)
+
+    if error:
+        async with _send_limiter:
+            await c.send_message(m.chat.id, error)
+        return
+    if mode == 'channel_id':
+        await _save_channel_info(user_id, chat)
+    await reply_and_track(c.send_message, m.chat.id, m.chat.id, done, reply_markup=menu_markup())
 
-@bot.on_message(filters.private & filters.forwarded)
+@bot.on_message(filters.private & filters.forwarded & awaiting('forward_channel'))
 async def handle_forward(c: Client, m: Message):
     user_id = m.from_user.id
-    if waiting_for_input.get(user_id) != 'forward_channel':
-        return
-    try:
-        await m.delete()
-    except:
-        pass
-    await _delete_last(c, m.chat.id)
+    _delete_input_and_last(c, m)
     if not m.forward_from_chat:
-        sent = await c.send_message(m.chat.id, '❌ Please forward a message from a channel or group')
-        last_bot_msgs[m.chat.id] = getattr(sent, 'message_id', getattr(sent, 'id', None))
+        await reply_and_track(c.send_message, m.chat.id, m.chat.id, '❌ Please forward a message from a channel or group')
         return
     chat = m.forward_from_chat
-    settings = await get_user_settings(user_id)
-    settings['target_chat_id'] = chat.id
-    await set_user_settings(user_id, settings)
+    async with get_lock(user_id):
+        settings = await get_user_settings(user_id)
+        settings['target_chat_id'] = chat.id
+        await set_user_settings(user_id, settings)
     await _save_channel_info(user_id, chat)
-    del waiting_for_input[user_id]
-    sent = await c.send_message(m.chat.id, f'✅ Channel set: {chat.title} ({chat.id})', reply_markup=menu_markup())
-    last_bot_msgs[m.chat.id] = getattr(sent, 'message_id', getattr(sent, 'id', None))
+    waiting_for_input.pop(user_id, None)
+    await reply_and_track(c.send_message, m.chat.id, m.chat.id, f'✅ Channel set: {chat.title} ({chat.id})', reply_markup=menu_markup())
 
-@bot.on_message(filters.private & (filters.photo | filters.video | filters.animation))
+@bot.on_message(filters.private & (filters.photo | filters.video | filters.animation) & awaiting('admin_welcome') & admins)
 async def handle_media_admin(c: Client, m: Message):
     user_id = m.from_user.id
-    if waiting_for_input.get(user_id) != 'admin_welcome':
-        return
-    if user_id not in ADMIN_IDS:
-        return
-    try:
-        await m.delete()
-    except:
-        pass
-    await _delete_last(c, m.chat.id)
+    _delete_input_and_last(c, m)
     file_id = None
     msg_type = None
     if m.photo:
@@ -519,47 +955,64 @@ async def handle_media_admin(c: Client, m: Message):
         file_id = m.animation.file_id
         msg_type = 'animation'
     if not file_id:
-        sent = await c.send_message(m.chat.id, '❌ Unsupported media')
-        last_bot_msgs[m.chat.id] = getattr(sent, 'message_id', getattr(sent, 'id', None))
+        await reply_and_track(c.send_message, m.chat.id, m.chat.id, '❌ Unsupported media')
         return
     waiting_for_input[f'{user_id}_welcome_data'] = {'message_type': msg_type, 'file_id': file_id}
     waiting_for_input[user_id] = 'admin_welcome_caption'
-    sent = await c.send_message(m.chat.id, '✅ Media received. Now send caption (HTML ok).')
-    last_bot_msgs[m.chat.id] = getattr(sent, 'message_id', getattr(sent, 'id', None))
+    await reply_and_track(c.send_message, m.chat.id, m.chat.id, '✅ Media received. Now send caption (HTML ok).')
 
 @bot.on_message(filters.private & filters.video & ~filters.forwarded)
 async def handle_video_upload(c: Client, m: Message):
-    user_id = m.from_user.id
-    if user_id in waiting_for_input:
+    if m.from_user.id in waiting_for_input:
         return
-    lock = get_lock(user_id)
-    async with lock:
+    # Hand the upload off so a slow copy never ties up one of pyrogram's update
+    # workers; uploads stay ordered within a chat while chats run in parallel.
+    if not enqueue_for_chat(m.chat.id, functools.partial(_process_video, c, m)):
+        async with _send_limiter:
+            await m.reply('⚠️ Bot is restarting. Send this video again in a minute.')
+
+# Failures caused by the user's channel setup or Telegram rate limits; these
+# are logged as one-line warnings instead of full tracebacks
+EXPECTED_UPLOAD_ERRORS = (FloodWait, ChatWriteForbidden, ChatAdminRequired, PeerIdInvalid)
+
+async def _process_video(c: Client, m: Message):
+    user_id = m.from_user.id
+    # Only the settings read -> copy -> counter update is serialised per user;
+    # the status reply goes out after the lock is released
+    async with get_lock(user_id):
         try:
             settings = await get_user_settings(user_id)
             target = settings.get('target_chat_id')
-            if not target:
-                await m.reply('⚠️ No target set. Use menu to set channel.')
-                return
             quals = settings.get('selected_qualities', [])
-            if not quals:
-                await m.reply('⚠️ No qualities selected. Configure in menu.')
-                return
-            idx = settings.get('video_count', 0) % len(quals)
-            q = quals[idx]
-            caption = render_caption(settings.get('base_caption', DEFAULT_CAPTION), settings, q)
-            await c.copy_message(chat_id=target, from_chat_id=m.chat.id, message_id=m.message_id, caption=caption, parse_mode=ParseMode.HTML)
-            await log_upload_event(user_id, {'quality': q, 'season': settings['season'], 'episode': settings['episode']})
-            settings['video_count'] = settings.get('video_count', 0) + 1
-            if settings['video_count'] >= len(quals):
-                settings['episode'] = settings.get('episode', 1) + 1
-                settings['video_count'] = 0
-                await c.send_message(m.chat.id, f'✅ Episode {settings["episode"]-1} complete. Next Episode: {settings["episode"]}', parse_mode=ParseMode.HTML)
+            if not target:
+                text = '⚠️ No target set. Use menu to set channel.'
+            elif not quals:
+                text = '⚠️ No qualities selected. Configure in menu.'
             else:
-                await c.send_message(m.chat.id, f'✅ Uploaded {q}. Progress: {settings["video_count"]}/{len(quals)}', parse_mode=ParseMode.HTML)
-            await set_user_settings(user_id, settings)
+                idx = settings.get('video_count', 0) % len(quals)
+                q = quals[idx]
+                caption = render_caption(settings.get('base_caption', DEFAULT_CAPTION), settings, q)
+                # Message.copy re-sends the cached media by file_id; copy_message
+                # would first re-fetch the message we already have
+                async with _send_limiter:
+                    await m.copy(target, caption=caption, parse_mode=ParseMode.HTML)
+                upload = {'quality': q, 'season': settings['season'], 'episode': settings['episode']}
+                settings['video_count'] = settings.get('video_count', 0) + 1
+                if settings['video_count'] >= len(quals):
+                    settings['episode'] = settings.get('episode', 1) + 1
+                    settings['video_count'] = 0
+                    text = f'✅ Episode {settings["episode"]-1} complete. Next Episode: {settings["episode"]}'
+                else:
+                    text = f'✅ Uploaded {q}. Progress: {settings["video_count"]}/{len(quals)}'
+                await commit_upload(user_id, settings, upload)
+        except EXPECTED_UPLOAD_ERRORS as e:
+            logger.warning('Upload failed for user %d: %s', user_id, e)
+            text = f'❌ Upload failed: {e}'
         except Exception as e:
-            logger.exception('Upload error')
-            await m.reply(f'❌ Upload failed: {e}')
+            logger.exception('Upload error for user %d', user_id)
+            text = f'❌ Upload failed: {e}'
+    async with _send_limiter:
+        await m.reply(text, quote=False, disable_notification=True)
 
 # ==================== END OF PART 5 ====================
 
@@ -567,188 +1020,183 @@ async def handle_video_upload(c: Client, m: Message):
 
 @bot.on_callback_query()
 async def handle_callback(c: Client, cq: CallbackQuery):
-    data = cq.data
+    data = cq.data or ''
+    action = data.partition(':')[0]
     user_id = cq.from_user.id
     chat_id = cq.message.chat.id
-    settings = await get_user_settings(user_id)
-    await cq.answer()
-    await _delete_last(c, chat_id)
-
-    # Admin callbacks
-    if data == 'admin_set_welcome' and user_id in ADMIN_IDS:
-        waiting_for_input[user_id] = 'admin_welcome'
-        sent = await cq.message.reply('Send a photo/video/animation for welcome (admins only).')
-        last_bot_msgs[chat_id] = getattr(sent, 'message_id', getattr(sent, 'id', None))
-        return
-    
-    if data == 'admin_preview_welcome' and user_id in ADMIN_IDS:
-        w = await _get_welcome()
-        if not w:
-            sent = await cq.message.reply('No welcome configured')
-            last_bot_msgs[chat_id] = getattr(sent, 'message_id', getattr(sent, 'id', None))
-            return
-        cap = (w.get('caption') or '').format(first_name='Test', user_id=0)
-        try:
-            if w.get('message_type') == 'photo':
-                await c.send_photo(chat_id, w['file_id'], caption=f'👁️ Preview\n{cap}', parse_mode=ParseMode.HTML)
-            elif w.get('message_type') == 'video':
-                await c.send_video(chat_id, w['file_id'], caption=f'👁️ Preview\n{cap}', parse_mode=ParseMode.HTML)
-            elif w.get('message_type') == 'animation':
-                await c.send_animation(chat_id, w['file_id'], caption=f'👁️ Preview\n{cap}', parse_mode=ParseMode.HTML)
-        except Exception as e:
-            await c.send_message(chat_id, f'Preview failed: {e}')
-        sent = await c.send_message(chat_id, 'Admin menu', reply_markup=admin_markup())
-        last_bot_msgs[chat_id] = getattr(sent, 'message_id', getattr(sent, 'id', None))
-        return
-    
-    if data == 'admin_global_stats' and user_id in ADMIN_IDS:
-        total = await _get_all_users_count()
-        sent = await cq.message.reply(f'Global users: {total} | Storage: {"Postgres" if (USE_ASYNCPG or USE_PSYCOG) else "JSON"}')
-        last_bot_msgs[chat_id] = getattr(sent, 'message_id', getattr(sent, 'id', None))
+    # Menu navigation edits the pressed message in place (see replace_menu)
+    if action not in IN_PLACE_CALLBACKS:
+        _delete_last(c, chat_id)
+    # The settings read and the callback ack don't depend on each other,
+    # so they share one round-trip window
+    settings, _ = await asyncio.gather(get_user_settings(user_id), cq.answer())
+
+    handler = CALLBACK_HANDLERS.get(action)
+    if handler is None and user_id in ADMIN_IDS:
+        handler = ADMIN_CALLBACK_HANDLERS.get(action)
+    if handler is None:
         return
+    try:
+        await handler(c, cq, settings, user_id, chat_id)
+    except RPCError as e:
+        # Telegram refusing an edit/send (stale message, flood wait, ...) needs no traceback
+        logger.warning('Callback %s failed for user %d: %s', data, user_id, e)
+    except Exception:
+        logger.exception('Callback %s failed for user %d', data, user_id)
 
-    # User callbacks
-    if data == 'preview':
-        target = settings.get('target_chat_id')
-        target_disp = f'<code>{target}</code>' if target else '❌ Not set'
-        next_q = settings['selected_qualities'][settings['video_count'] % len(settings['selected_qualities'])] if settings['selected_qualities'] else 'N/A'
-        preview = render_caption(settings.get('base_caption', DEFAULT_CAPTION), settings, next_q)
-        sent = await cq.message.reply(f'🔍 Caption Preview:\n{preview}\n\nChannel: {target_disp}', parse_mode=ParseMode.HTML, reply_markup=menu_markup())
-        last_bot_msgs[chat_id] = getattr(sent, 'message_id', getattr(sent, 'id', None))
-        return
-    
-    if data == 'set_caption':
-        waiting_for_input[user_id] = 'caption'
-        sent = await cq.message.reply('Send new caption template (placeholders: {season},{episode},{total_episode},{quality})', reply_markup=menu_markup())
-        last_bot_msgs[chat_id] = getattr(sent, 'message_id', getattr(sent, 'id', None))
-        return
-    
-    if data == 'set_season':
-        waiting_for_input[user_id] = 'season'
-        sent = await cq.message.reply('Send season number', reply_markup=menu_markup())
-        last_bot_msgs[chat_id] = getattr(sent, 'message_id', getattr(sent, 'id', None))
-        return
-    
-    if data == 'set_episode':
-        waiting_for_input[user_id] = 'episode'
-        sent = await cq.message.reply('Send episode number (will reset progress)', reply_markup=menu_markup())
-        last_bot_msgs[chat_id] = getattr(sent, 'message_id', getattr(sent, 'id', None))
-        return
-    
-    if data == 'set_total_episode':
-        waiting_for_input[user_id] = 'total_episode'
-        sent = await cq.message.reply('Send total episodes count', reply_markup=menu_markup())
-        last_bot_msgs[chat_id] = getattr(sent, 'message_id', getattr(sent, 'id', None))
-        return
-    
-    if data == 'quality_menu':
-        sent = await cq.message.reply('Toggle qualities', reply_markup=quality_markup(settings.get('selected_qualities', [])))
-        last_bot_msgs[chat_id] = getattr(sent, 'message_id', getattr(sent, 'id', None))
-        return
-    
-    if data and data.startswith('toggle_quality_'):
-        q = data.split('toggle_quality_')[-1]
-        async with get_lock(user_id):
-            sel = settings.get('selected_qualities', [])
-            if q in sel:
-                sel.remove(q)
-            else:
-                sel.append(q)
-                sel.sort(key=lambda x: ALL_QUALITIES.index(x) if x in ALL_QUALITIES else 999)
-            settings['selected_qualities'] = sel
-            await set_user_settings(user_id, settings)
-        try:
-            await cq.message.edit_text('Toggle qualities', reply_markup=quality_markup(settings.get('selected_qualities', [])))
-        except Exception:
-            pass
-        return
-    
-    if data == 'set_channel':
-        sent = await cq.message.reply('Choose method', reply_markup=channel_markup())
-        last_bot_msgs[chat_id] = getattr(sent, 'message_id', getattr(sent, 'id', None))
-        return
-    
-    if data == 'forward_channel':
-        waiting_for_input[user_id] = 'forward_channel'
-        sent = await cq.message.reply('Forward a message from your target channel')
-        last_bot_msgs[chat_id] = getattr(sent, 'message_id', getattr(sent, 'id', None))
-        return
-    
-    if data == 'send_channel_id':
-        waiting_for_input[user_id] = 'channel_id'
-        sent = await cq.message.reply('Send the channel username (@name) or ID (-100...)')
-        last_bot_msgs[chat_id] = getattr(sent, 'message_id', getattr(sent, 'id', None))
-        return
-    
-    if data == 'stats':
-        total, today = await _get_user_upload_stats(user_id)
-        sent = await cq.message.reply(f'Your uploads: total {total} | today {today}', reply_markup=menu_markup())
-        last_bot_msgs[chat_id] = getattr(sent, 'message_id', getattr(sent, 'id', None))
-        return
-    
-    if data == 'reset':
-        async with get_lock(user_id):
-            settings['episode'] = 1
-            settings['video_count'] = 0
-            await set_user_settings(user_id, settings)
-        sent = await cq.message.reply('Progress reset', reply_markup=menu_markup())
-        last_bot_msgs[chat_id] = getattr(sent, 'message_id', getattr(sent, 'id', None))
-        return
-    
-    if data == 'back_to_main' or data == 'cancel':
-        if user_id in waiting_for_input:
-            del waiting_for_input[user_id]
-        if f'{user_id}_welcome_data' in waiting_for_input:
-            del waiting_for_input[f'{user_id}_welcome_data']
-        try:
-            await cq.message.delete()
-        except:
-            pass
-        sent = await c.send_message(chat_id, 'Main menu', reply_markup=menu_markup())
-        last_bot_msgs[chat_id] = getattr(sent, 'message_id', getattr(sent, 'id', None))
+# ---- Admin callbacks ----
+async def _cb_admin_set_welcome(c, cq, settings, user_id, chat_id):
+    waiting_for_input[user_id] = 'admin_welcome'
+    await reply_and_track(cq.message.reply, chat_id, 'Send a photo/video/animation for welcome (admins only).')
+
+async def _cb_admin_preview_welcome(c, cq, settings, user_id, chat_id):
+    w = await _get_welcome()
+    if not w:
+        await reply_and_track(cq.message.reply, chat_id, 'No welcome configured')
         return
+    cap = (w.get('caption') or '').format(first_name='Test', user_id=0)
+    send = {'photo': c.send_photo, 'video': c.send_video, 'animation': c.send_animation}.get(w.get('message_type'))
+    try:
+        if send is not None:
+            async with _send_limiter:
+                await send(chat_id, w['file_id'], caption=f'👁️ Preview\n{cap}', parse_mode=ParseMode.HTML)
+    except Exception as e:
+        async with _send_limiter:
+            await c.send_message(chat_id, f'Preview failed: {e}')
+    await reply_and_track(c.send_message, chat_id, chat_id, 'Admin menu', reply_markup=admin_markup())
+
+async def _cb_admin_global_stats(c, cq, settings, user_id, chat_id):
+    total = await _get_all_users_count()
+    await reply_and_track(cq.message.reply, chat_id, GLOBAL_STATS_TEMPLATE % {'total': total, 'storage': 'Postgres' if (USE_ASYNCPG or USE_PSYCOG) else 'JSON'})
+
+# ---- User callbacks ----
+async def _cb_preview(c, cq, settings, user_id, chat_id):
+    target = settings.get('target_chat_id')
+    target_disp = f'<code>{target}</code>' if target else '❌ Not set'
+    next_q = settings['selected_qualities'][settings['video_count'] % len(settings['selected_qualities'])] if settings['selected_qualities'] else 'N/A'
+    preview = render_caption(settings.get('base_caption', DEFAULT_CAPTION), settings, next_q)
+    await reply_and_track(cq.message.reply, chat_id, PREVIEW_TEMPLATE % {'preview': preview, 'target': target_disp}, parse_mode=ParseMode.HTML, reply_markup=menu_markup())
+
+async def _cb_set_caption(c, cq, settings, user_id, chat_id):
+    waiting_for_input[user_id] = 'caption'
+    await reply_and_track(cq.message.reply, chat_id, CAPTION_PROMPT, reply_markup=menu_markup())
+
+async def _cb_set_season(c, cq, settings, user_id, chat_id):
+    waiting_for_input[user_id] = 'season'
+    await reply_and_track(cq.message.reply, chat_id, 'Send season number', reply_markup=menu_markup())
+
+async def _cb_set_episode(c, cq, settings, user_id, chat_id):
+    waiting_for_input[user_id] = 'episode'
+    await reply_and_track(cq.message.reply, chat_id, 'Send episode number (will reset progress)', reply_markup=menu_markup())
+
+async def _cb_set_total_episode(c, cq, settings, user_id, chat_id):
+    waiting_for_input[user_id] = 'total_episode'
+    await reply_and_track(cq.message.reply, chat_id, 'Send total episodes count', reply_markup=menu_markup())
+
+async def _cb_quality_menu(c, cq, settings, user_id, chat_id):
+    await reply_and_track(cq.message.reply, chat_id, QUALITY_MENU_TEXT, reply_markup=quality_markup(settings.get('selected_qualities', [])))
+
+async def _cb_toggle_quality(c, cq, settings, user_id, chat_id):
+    q = cq.data.partition(':')[2]
+    async with get_lock(user_id):
+        # re-read under the lock so a concurrent upload's counter update isn't overwritten
+        settings = await get_user_settings(user_id)
+        sel = settings.get('selected_qualities', [])
+        if q in sel:
+            sel.remove(q)
+        else:
+            sel.append(q)
+            sel.sort(key=lambda x: ALL_QUALITIES.index(x) if x in ALL_QUALITIES else 999)
+        settings['selected_qualities'] = sel
+        await set_user_settings(user_id, settings)
+    await replace_menu(c, cq, QUALITY_MENU_TEXT, quality_markup(settings.get('selected_qualities', [])))
+
+async def _cb_set_channel(c, cq, settings, user_id, chat_id):
+    await reply_and_track(cq.message.reply, chat_id, 'Choose method', reply_markup=channel_markup())
+
+async def _cb_forward_channel(c, cq, settings, user_id, chat_id):
+    waiting_for_input[user_id] = 'forward_channel'
+    await reply_and_track(cq.message.reply, chat_id, 'Forward a message from your target channel')
+
+async def _cb_send_channel_id(c, cq, settings, user_id, chat_id):
+    waiting_for_input[user_id] = 'channel_id'
+    await reply_and_track(cq.message.reply, chat_id, 'Send the channel username (@name) or ID (-100...)')
+
+async def _cb_stats(c, cq, settings, user_id, chat_id):
+    total, today = await _get_user_upload_stats(user_id)
+    await replace_menu(c, cq, UPLOAD_STATS_TEMPLATE % {'total': total, 'today': today}, menu_markup())
+
+async def _cb_reset(c, cq, settings, user_id, chat_id):
+    async with get_lock(user_id):
+        settings = await get_user_settings(user_id)
+        settings['episode'] = 1
+        settings['video_count'] = 0
+        await set_user_settings(user_id, settings)
+    await replace_menu(c, cq, 'Progress reset', menu_markup())
+
+async def _cb_back_to_main(c, cq, settings, user_id, chat_id):
+    waiting_for_input.pop(user_id, None)
+    waiting_for_input.pop(f'{user_id}_welcome_data', None)
+    await replace_menu(c, cq, 'Main menu', menu_markup())
+
+# callback action -> handler
+CALLBACK_HANDLERS = {
+    'preview': _cb_preview,
+    'set_caption': _cb_set_caption,
+    'set_season': _cb_set_season,
+    'set_episode': _cb_set_episode,
+    'set_total_episode': _cb_set_total_episode,
+    'quality_menu': _cb_quality_menu,
+    TOGGLE_QUALITY: _cb_toggle_quality,
+    'set_channel': _cb_set_channel,
+    'forward_channel': _cb_forward_channel,
+    'send_channel_id': _cb_send_channel_id,
+    'stats': _cb_stats,
+    'reset': _cb_reset,
+    'back_to_main': _cb_back_to_main,
+    'cancel': _cb_back_to_main,
+}
+
+ADMIN_CALLBACK_HANDLERS = {
+    'admin_set_welcome': _cb_admin_set_welcome,
+    'admin_preview_welcome': _cb_admin_preview_welcome,
+    'admin_global_stats': _cb_admin_global_stats,
+}
 
 # ==================== END OF PART 6 ====================
 
 # ==================== PART 7: HELPER FUNCTIONS ====================
 
 async def _save_channel_info(user_id, chat):
-    if USE_ASYNCPG and _pg_pool:
-        async with _pg_pool.acquire() as conn:
-            try:
-                await conn.execute('CREATE TABLE IF NOT EXISTS channel_info (user_id BIGINT, chat_id BIGINT, username TEXT, title TEXT, type TEXT, PRIMARY KEY(user_id, chat_id))')
+    try:
+        if USE_ASYNCPG and _pg_pool:
+            async with _pg_pool.acquire() as conn:
                 await conn.execute('INSERT INTO channel_info (user_id, chat_id, username, title, type) VALUES ($1,$2,$3,$4,$5) ON CONFLICT (user_id, chat_id) DO UPDATE SET username=EXCLUDED.username, title=EXCLUDED.title, type=EXCLUDED.type', user_id, chat.id, getattr(chat, 'username', None), getattr(chat, 'title', None), str(getattr(chat, 'type', '')))
-            except Exception:
-                pass
-    elif USE_PSYCOG and _psycopg_pool:
-        async with _psycopg_pool.connection() as conn:
-            async with conn.cursor() as cur:
-                try:
-                    await cur.execute("CREATE TABLE IF NOT EXISTS channel_info (user_id BIGINT, chat_id BIGINT, username TEXT, title TEXT, type TEXT, PRIMARY KEY(user_id, chat_id))")
-                    await cur.execute("INSERT INTO channel_info (user_id, chat_id, username, title, type) VALUES (%s,%s,%s,%s,%s) ON CONFLICT (user_id, chat_id) DO UPDATE SET username=EXCLUDED.username, title=EXCLUDED.title, type=EXCLUDED.type", (user_id, chat.id, getattr(chat, 'username', None), getattr(chat, 'title', None), str(getattr(chat, 'type', ''))))
-                    await conn.commit()
-                except Exception:
-                    pass
-    else:
-        k = str(user_id)
-        u = fallback['users'].get(k, {})
-        u['channel_info'] = {'chat_id': getattr(chat, 'id', None), 'username': getattr(chat, 'username', None), 'title': getattr(chat, 'title', None)}
-        fallback['users'][k] = u
-        await save_fallback()
+            return
+        if USE_PSYCOG and _psycopg_pool:
+            async with _psycopg_pool.connection() as conn:
+                async with conn.cursor() as cur:
+                    await cur.execute("INSERT INTO channel_info (user_id, chat_id, username, title, type) VALUES (%s,%s,%s,%s,%s) ON CONFLICT (user_id, chat_id) DO UPDATE SET username=EXCLUDED.username, title=EXCLUDED.title, type=EXCLUDED.type", (user_id, chat.id, getattr(chat, 'username', None), getattr(chat, 'title', None), str(getattr(chat, 'type', ''))), prepare=True)
+            return
+    except DB_ERRORS as e:
+        logger.warning('Failed to save channel info for user %d: %s', user_id, e)
+        return
+    k = str(user_id)
+    u = fallback['users'].get(k, {})
+    u['channel_info'] = {'chat_id': getattr(chat, 'id', None), 'username': getattr(chat, 'username', None), 'title': getattr(chat, 'title', None)}
+    fallback['users'][k] = u
+    await save_fallback()
 
 async def _get_user_upload_stats(user_id):
     if USE_ASYNCPG and _pg_pool:
         async with _pg_pool.acquire() as conn:
-            total = await conn.fetchval('SELECT COUNT(*) FROM uploads WHERE user_id=$1', user_id)
-            today = await conn.fetchval("SELECT COUNT(*) FROM uploads WHERE user_id=$1 AND DATE(ts) = CURRENT_DATE", user_id)
+            total, today = await conn.fetchrow(PG_UPLOAD_STATS, user_id)
             return int(total or 0), int(today or 0)
     if USE_PSYCOG and _psycopg_pool:
         async with _psycopg_pool.connection() as conn:
             async with conn.cursor() as cur:
-                await cur.execute('SELECT COUNT(*) FROM uploads WHERE user_id=%s', (user_id,))
-                total = (await cur.fetchone())[0]
-                await cur.execute('SELECT COUNT(*) FROM uploads WHERE user_id=%s AND DATE(ts)=CURRENT_DATE', (user_id,))
-                today = (await cur.fetchone())[0]
+                await cur.execute(PSY_UPLOAD_STATS, (user_id,), prepare=True)
+                total, today = await cur.fetchone()
                 return int(total or 0), int(today or 0)
     total = sum(1 for u in fallback['uploads'] if u.get('user_id') == user_id)
     today = sum(1 for u in fallback['uploads'] if u.get('user_id') == user_id and u.get('ts', '').startswith(datetime.now(timezone.utc).date().isoformat()))
@@ -766,57 +1214,109 @@ async def _get_all_users_count():
     return len(fallback['users'])
 
 async def _save_welcome(message_type, file_id, caption):
-    if USE_ASYNCPG and _pg_pool:
-        async with _pg_pool.acquire() as conn:
-            try:
-                await conn.execute('CREATE TABLE IF NOT EXISTS welcome_settings (id SERIAL PRIMARY KEY, message_type TEXT, file_id TEXT, caption TEXT)')
-                await conn.execute('DELETE FROM welcome_settings')
-                await conn.execute('INSERT INTO welcome_settings (message_type, file_id, caption) VALUES ($1,$2,$3)', message_type, file_id, caption)
-                return True
-            except Exception:
-                return False
-    if USE_PSYCOG and _psycopg_pool:
-        async with _psycopg_pool.connection() as conn:
-            async with conn.cursor() as cur:
-                try:
-                    await cur.execute('CREATE TABLE IF NOT EXISTS welcome_settings (id SERIAL PRIMARY KEY, message_type TEXT, file_id TEXT, caption TEXT)')
-                    await cur.execute('DELETE FROM welcome_settings')
-                    await cur.execute('INSERT INTO welcome_settings (message_type, file_id, caption) VALUES (%s,%s,%s)', (message_type, file_id, caption))
-                    await conn.commit()
-                    return True
-                except Exception:
-                    return False
+    global _welcome_cache
+    ok = await _store_welcome(message_type, file_id, caption)
+    _welcome_cache = None
+    return ok
+
+async def _store_welcome(message_type, file_id, caption):
+    try:
+        if USE_ASYNCPG and _pg_pool:
+            async with _pg_pool.acquire() as conn:
+                async with conn.transaction():
+                    await conn.execute('DELETE FROM welcome_settings')
+                    await conn.execute('INSERT INTO welcome_settings (message_type, file_id, caption) VALUES ($1,$2,$3)', message_type, file_id, caption)
+            return True
+        if USE_PSYCOG and _psycopg_pool:
+            async with _psycopg_pool.connection() as conn:
+                async with conn.cursor() as cur:
+                    # Pipeline mode ships BEGIN, DELETE, INSERT and COMMIT without waiting on each reply
+                    async with conn.pipeline(), conn.transaction():
+                        await cur.execute('DELETE FROM welcome_settings')
+                        await cur.execute('INSERT INTO welcome_settings (message_type, file_id, caption) VALUES (%s,%s,%s)', (message_type, file_id, caption))
+            return True
+    except DB_ERRORS as e:
+        logger.warning('Failed to save welcome message: %s', e)
+        return False
     fallback['welcome'] = {'message_type': message_type, 'file_id': file_id, 'caption': caption}
     await save_fallback()
     return True
 
 async def _get_welcome():
-    if USE_ASYNCPG and _pg_pool:
-        async with _pg_pool.acquire() as conn:
-            try:
-                row = await conn.fetchrow('SELECT * FROM welcome_settings ORDER BY id DESC LIMIT 1')
-                return dict(row) if row else None
-            except Exception:
-                return None
-    if USE_PSYCOG and _psycopg_pool:
-        async with _psycopg_pool.connection() as conn:
-            async with conn.cursor() as cur:
-                try:
-                    await cur.execute('SELECT * FROM welcome_settings ORDER BY id DESC LIMIT 1')
-                    r = await cur.fetchone()
-                    if not r:
-                        return None
-                    cols = [d[0] for d in cur.description]
-                    return dict(zip(cols, r))
-                except Exception:
-                    return None
-    return fallback.get('welcome')
-
-async def _delete_last(client, chat_id):
+    # The welcome payload changes rarely; /start and the admin preview share one cached copy
+    global _welcome_cache
+    if _welcome_cache and time.monotonic() - _welcome_cache[0] < SETTINGS_CACHE_TTL:
+        return _welcome_cache[1]
+    welcome = await _load_welcome()
+    _welcome_cache = (time.monotonic(), welcome)
+    return welcome
+
+async def _load_welcome():
+    try:
+        if USE_ASYNCPG and _pg_pool:
+            async with _pg_pool.acquire() as conn:
+                row = await conn.fetchrow('SELECT message_type, file_id, caption FROM welcome_settings ORDER BY id DESC LIMIT 1')
+        elif USE_PSYCOG and _psycopg_pool:
+            async with _psycopg_pool.connection() as conn:
+                async with conn.cursor() as cur:
+                    await cur.execute('SELECT message_type, file_id, caption FROM welcome_settings ORDER BY id DESC LIMIT 1')
+                    row = await cur.fetchone()
+        else:
+            return fallback.get('welcome')
+    except DB_ERRORS as e:
+        logger.warning('Failed to load welcome message: %s', e)
+        return None
+    if not row:
+        return None
+    message_type, file_id, caption = row
+    return {'message_type': message_type, 'file_id': file_id, 'caption': caption}
+
+async def replace_menu(client, cq, text, markup):
+    """Edit the pressed menu in place; fall back to delete + send if it can't be edited"""
+    chat_id = cq.message.chat.id
+    if last_bot_msgs.get(chat_id) != cq.message.id:
+        _delete_last(client, chat_id)
     try:
-        if chat_id in last_bot_msgs:
-            await client.delete_messages(chat_id, last_bot_msgs[chat_id])
-            del last_bot_msgs[chat_id]
+        async with _send_limiter:
+            await cq.message.edit_text(text, parse_mode=ParseMode.HTML, reply_markup=markup)
+    except MessageNotModified:
+        pass
+    except RPCError:
+        # e.g. media welcome messages have no text to edit
+        try:
+            await cq.message.delete()
+        except RPCError:
+            pass
+        await reply_and_track(client.send_message, chat_id, chat_id, text, parse_mode=ParseMode.HTML, reply_markup=markup)
+        return
+    last_bot_msgs[chat_id] = cq.message.id
+
+async def reply_and_track(send, chat_id, *args, **kwargs):
+    """Await `send(*args, **kwargs)` and remember the sent message as the chat's last bot message"""
+    async with _send_limiter:
+        sent = await send(*args, **kwargs)
+    last_bot_msgs[chat_id] = sent.id
+    return sent
+
+# Deletes are fire-and-forget: nobody waits on their result, so the handler
+# moves on to its reply while they run. The ids are taken from last_bot_msgs
+# right away so the reply the handler is about to track is never the one deleted.
+def _delete_input_and_last(client, m):
+    """Delete the user's message and the chat's last bot message in one request"""
+    ids = [m.id]
+    last = last_bot_msgs.pop(m.chat.id, None)
+    if last is not None:
+        ids.append(last)
+    spawn(_delete_quietly(client, m.chat.id, ids))
+
+def _delete_last(client, chat_id):
+    last = last_bot_msgs.pop(chat_id, None)
+    if last is not None:
+        spawn(_delete_quietly(client, chat_id, last))
+
+async def _delete_quietly(client, chat_id, ids):
+    try:
+        await client.delete_messages(chat_id, ids)
     except Exception:
         pass
 
@@ -831,71 +1331,169 @@ async def health(request):
 async def root(request):
     return web.Response(text='Bot Running', status=200)
 
+# /health is what the self-ping and uptime monitors hit, so it's listed first
+WEB_ROUTES = (
+    web.get('/health', health),
+    web.get('/', root),
+)
+
 async def start_web_server():
     """Start web server for Render health checks"""
-    web_app.add_routes([
-        web.get('/health', health),
-        web.get('/', root)
-    ])
+    web_app.add_routes(WEB_ROUTES)
     
-    runner = web.AppRunner(web_app)
+    runner = web.AppRunner(web_app, access_log=None)  # keep-alive pings would flood the log
     await runner.setup()
-    site = web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT)
+    # Rebind immediately over the previous instance's socket during a redeploy;
+    # SO_REUSEPORT isn't available on Windows
+    site = web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT, reuse_address=True, reuse_port=sys.platform != 'win32', backlog=512)
     await site.start()
-    logger.info(f'✅ Web server started on {WEBHOOK_HOST}:{WEBHOOK_PORT}')
+    logger.info('✅ Web server started on %s:%d', WEBHOOK_HOST, WEBHOOK_PORT)
     return runner
 
-if __name__ == '__main__':
-    import sys
-    import signal
-    import threading
-    import time
-    
-    def signal_handler(sig, frame):
-        logger.info("🛑 Received shutdown signal")
-        sys.exit(0)
-    
-    signal.signal(signal.SIGINT, signal_handler)
-    signal.signal(signal.SIGTERM, signal_handler)
-    
+async def self_ping():
+    """Hit our own /health endpoint so Render's free tier doesn't put the service to sleep"""
+    if not SELF_PING_URL:
+        logger.info('SELF_PING_URL not set, self-ping disabled')
+        return
+    url = SELF_PING_URL.rstrip('/') + '/health'
+    timeout = ClientTimeout(total=5)
+    retry = SELF_PING_RETRY
+    # While the endpoint flaps, log one failure per window plus how many were swallowed
+    last_error_log = -SELF_PING_ERROR_LOG_INTERVAL
+    suppressed = 0
+    while True:
+        try:
+            async with http_session.head(url, allow_redirects=False, timeout=timeout) as resp:
+                logger.info('🏓 Self-ping %s -> %d', url, resp.status)
+                ok = resp.status == 200
+        except Exception as e:
+            ok = False
+            now = time.monotonic()
+            if now - last_error_log >= SELF_PING_ERROR_LOG_INTERVAL:
+                logger.warning('Self-ping failed: %s (%d similar failures suppressed)', e, suppressed)
+                last_error_log, suppressed = now, 0
+            else:
+                suppressed += 1
+        # Healthy: full interval. Failing: retry soon and back off towards the full interval.
+        if ok:
+            delay, retry = SELF_PING_INTERVAL, SELF_PING_RETRY
+        else:
+            delay, retry = retry, min(retry * 2, SELF_PING_INTERVAL)
+        # Jitter keeps restarted instances from pinging in lockstep
+        await asyncio.sleep(max(1, delay + random.uniform(-SELF_PING_JITTER, SELF_PING_JITTER)))
+
+def start_http_session():
+    global http_session
+    # One pooled session for all outbound HTTP; keep-alive connections and the
+    # DNS cache survive between requests instead of a handshake per call
+    http_session = ClientSession(connector=TCPConnector(limit=50, limit_per_host=20, ttl_dns_cache=3600, keepalive_timeout=75))
+
+def start_self_ping():
+    global _ping_task
+    _ping_task = spawn(self_ping())
+    _ping_task.add_done_callback(_on_self_ping_done)
+
+def _on_self_ping_done(task):
+    # A dead keep-alive means Render idles the service; bring it back after a short pause
+    if task.cancelled() or task.exception() is None:
+        return
+    logger.error('Self-ping task died: %s, restarting in %ds', task.exception(), SELF_PING_RETRY)
+    asyncio.get_running_loop().call_later(SELF_PING_RETRY, start_self_ping)
+
+async def main():
+    # Debug mode adds per-callback bookkeeping; never let PYTHONASYNCIODEBUG leak into production
+    asyncio.get_running_loop().set_debug(False)
+
+    # Park here until Render's SIGTERM (or Ctrl+C) instead of waking up on a timer.
+    # Installed before startup so a SIGTERM during the gather below is held
+    # until the bot is up and then shuts it down cleanly
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:
+            # Windows event loops have no add_signal_handler; a plain handler
+            # runs between bytecodes, so hand the set() over to the loop
+            signal.signal(sig, lambda *_: loop.call_soon_threadsafe(stop_event.set))
+
     logger.info('='*60)
     logger.info('🤖 Starting Telegram Bot with Long Polling Mode')
     logger.info('='*60)
-    
+
+    # The DB handshake, Telegram login and health-check port bind are
+    # independent; overlap them
+    logger.info("Initializing database, Pyrogram client and web server...")
+    _, _, runner = await asyncio.gather(init_db(), bot.start(), start_web_server())
+    _storage_ready.set()
+    logger.info("✅ Database, Pyrogram client and web server ready")
+
+    start_http_session()
+    start_self_ping()
+
+    logger.info('✅ ALL SYSTEMS OPERATIONAL')
+
+    try:
+        await stop_event.wait()
+        logger.info("🛑 Received shutdown signal")
+    finally:
+        # Let the ping task unwind before its HTTP session is closed under it
+        _ping_task.cancel()
+        await asyncio.gather(_ping_task, return_exceptions=True)
+
+        # An upload job that already copied the video to the channel must get
+        # to commit_upload, or the next run re-posts that quality. New videos
+        # are turned away from here on, and the queued ones get a bounded
+        # window while the client is still connected to send them.
+        await drain_chat_queues(CHAT_DRAIN_TIMEOUT)
+
+        # Pyrogram's stop() lets its workers finish the updates already queued,
+        # and those handlers still read and write settings; storage may only
+        # be flushed and closed once the client is fully stopped.
+        await _shutdown_step('pyrogram client', bot.stop())
+
+        # The web server and HTTP session don't touch storage or the client
+        await asyncio.gather(
+            _shutdown_step('web server', runner.cleanup()),
+            _shutdown_step('HTTP session', http_session.close()),
+        )
+        await _shutdown_step('storage', _close_storage())
+        logger.info("👋 Bot stopped")
+
+async def _shutdown_step(name, coro):
+    try:
+        await coro
+    except Exception as e:
+        logger.error('Failed to stop %s: %s', name, e)
+
+async def _close_storage():
+    global _settings_flush_task, _fallback_save_task
+    # Write out settings and upload records still waiting in memory before the pools go away.
+    # The debounce tasks are cleared, not just cancelled, so a late write schedules a new one
+    # Each step is guarded on its own so one failure can't skip the rest
+    if _settings_flush_task is not None:
+        _settings_flush_task.cancel()
+        _settings_flush_task = None
+    await _shutdown_step('settings writer', flush_settings())
+    # Stop the periodic flusher first so it can't be mid-write when the pools close
+    if _upload_flusher is not None:
+        _upload_flusher.cancel()
+        await asyncio.gather(_upload_flusher, return_exceptions=True)
+    await _shutdown_step('upload writer', flush_uploads())
+    await _shutdown_step('database pools', close_db())
+    if _fallback_save_task is not None:
+        _fallback_save_task.cancel()
+        _fallback_save_task = None
+        await _shutdown_step('fallback file writer', write_fallback())
+
+if __name__ == '__main__':
     try:
-        # Initialize database and web server in a separate thread
-        def init_services():
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-            
-            logger.info("Initializing database...")
-            loop.run_until_complete(init_db())
-            logger.info("✅ Database initialized successfully!")
-            
-            logger.info("Starting web server...")
-            loop.run_until_complete(start_web_server())
-            
-            # Keep the loop running for the web server
-            loop.run_forever()
-        
-        # Start services in background thread
-        services_thread = threading.Thread(target=init_services, daemon=True)
-        services_thread.start()
-        
-        # Wait for services to initialize
-        time.sleep(3)
-        
-        logger.info('='*60)
-        logger.info('STARTING PYROGRAM BOT...')
-        logger.info('='*60)
-        
-        sys.stdout.flush()
-        
-        # Start the bot in the main thread - THIS IS THE KEY!
-        bot.run()
-        
+        # Everything shares pyrogram's loop, so the DB pools, web server and
+        # handlers never cross event loops
+        bot.run(main())
     except KeyboardInterrupt:
-        logger.info("👋 Bot stopped by user")
+        # A second Ctrl+C while shutting down, or one before main() installs its handlers
+        logger.info("👋 Bot interrupted")
     except Exception as e:
         logger.exception(f"❌ FATAL ERROR: {e}")
         sys.exit(1)